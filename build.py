@@ -4,26 +4,129 @@
 # Font-Nexus
 # https://github.com/Arcitec/font-nexus
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import atexit
 import datetime
+import email.utils
+import errno
+import hashlib
+import http.client
+import json
 import os
 import re
 import shutil
 import subprocess
 import sys
 import time
+import urllib.error
 import urllib.parse
 import urllib.request
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows.
+    fcntl = None
+
 
 BASE_PATH = Path(sys.argv[0]).parent
 OUTPUT_PATH = BASE_PATH / "output"
 SOURCE_PATH = BASE_PATH / "source"
 TEMP_PATH = BASE_PATH / "temp"
+FAMILY_CACHE_PATH = BASE_PATH / ".family_cache.json"
+
+# Pre-compiled patterns for the hot loops, so that repeated calls skip the
+# regex cache lookup (and so the patterns have descriptive names).
+_DMG_URL_RE = re.compile(r'(?m)http[^"]+?\.dmg')
+_LEGACY_APPLE_RE = re.compile(
+    r"^(?:SF-(?:Pro|Compact)-(?:Text|Display)|NewYork(?:Small|Medium|Large|ExtraLarge)).*?\.otf$"
+)
+_FONT_EXT_RE = re.compile(r"\.(?:otf|ttf|ttc)$")
+
+
+def _load_family_cache() -> dict[str, str]:
+    try:
+        with open(FAMILY_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Missing or corrupt cache files are harmless. We'll just rebuild it.
+        return {}
+
+
+def _save_family_cache() -> None:
+    if not _family_cache_dirty:
+        return
+    with open(FAMILY_CACHE_PATH, "w", encoding="utf-8") as f:
+        json.dump(_family_cache, f, indent=2, sort_keys=True)
+
+
+# Persistent cache of font-file family names, keyed by path+size+mtime, so that
+# rebuilds with unchanged source files don't have to re-scan every font.
+_family_cache = _load_family_cache()
+_family_cache_dirty = False
+atexit.register(_save_family_cache)
+
+
+def _family_cache_key(font_file: Path, stat: os.stat_result = None) -> str:
+    # Callers that already hold the file's stat (e.g. from a scandir walk) can
+    # hand it in, which spares us from issuing another stat syscall here.
+    if stat is None:
+        stat = font_file.stat()
+    return f"{font_file.absolute()}|{stat.st_size}|{int(stat.st_mtime)}"
+
 
+MANIFEST_PATH = OUTPUT_PATH / ".manifest.json"
 
-def command_exists(cmd: str) -> bool:
-    return shutil.which(cmd) is not None
+
+def _load_manifest() -> dict[str, dict]:
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Missing or corrupt manifests are harmless. We'll just copy everything.
+        return {}
+
+
+def _save_manifest() -> None:
+    if not _manifest_dirty or not OUTPUT_PATH.is_dir():
+        return
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(_manifest, f, indent=2, sort_keys=True)
+
+
+# Manifest of all produced output files, keyed by their path relative to the
+# output directory, and describing the source file each one was copied from.
+# This lets warm rebuilds skip every copy whose source hasn't changed, instead
+# of wiping the whole output directory and re-copying everything.
+_manifest = _load_manifest()
+_manifest_dirty = False
+atexit.register(_save_manifest)
+
+
+def _source_hash(font_file: Path) -> str:
+    # Hashing only the head of the font is enough to detect version changes
+    # (the header tables change between releases), and keeps hashing cheap
+    # even for the humongous Asian font collections.
+    with open(font_file, "rb") as f:
+        return hashlib.sha256(f.read(65536)).hexdigest()
+
+
+def find_missing_deps(cmds: list[str]) -> list[str]:
+    # One walk over PATH that checks every dependency at once, instead of a
+    # full shutil.which scan per command (which also iterates PATHEXT on
+    # Windows). We stop as soon as everything has been found.
+    needed = set(cmds)
+    for path_entry in os.environ.get("PATH", "").split(os.pathsep):
+        if not path_entry:
+            continue
+        for name in list(needed):
+            candidate = Path(path_entry) / name
+            if candidate.exists() or candidate.with_name(f"{name}.exe").exists():
+                needed.discard(name)
+        if not needed:
+            break
+
+    return sorted(needed)
 
 
 def bytes_to_mib(bytes: int) -> str:
@@ -47,36 +150,214 @@ def rmtree(dir_name: Path) -> None:
 def create_font_output(dir_name: str) -> Path:
     target_path = OUTPUT_PATH / dir_name
 
-    if target_path.exists():
-        # Ensure that output target is clean.
-        rmtree(target_path)
-
-    target_path.mkdir(
-        mode=0o755, parents=True, exist_ok=False
-    )  # Throws if still exists.
+    # NOTE: We intentionally keep any previous build output here, since
+    # copy_fonts skips unchanged files and prunes obsolete ones through the
+    # manifest instead, which makes warm rebuilds nearly free.
+    target_path.mkdir(mode=0o755, parents=True, exist_ok=True)
 
     return target_path
 
 
+# The FICLONE ioctl number (from <linux/fs.h>), which isn't exposed by Python.
+_FICLONE = 0x40049409
+
+# Whether reflink cloning is worth attempting. Cleared after the first refusal,
+# so that non-CoW filesystems only pay for one failed ioctl per build.
+_reflink_works = fcntl is not None and sys.platform == "linux"
+
+# Opt-in hardlinked output (see README). Hardlinks skip the data copy entirely
+# on any POSIX filesystem, but the output files then share their content with
+# the sources, so consumers who expect independent files should leave this off.
+# Cleared on the first cross-device failure, since that can never recover.
+_hardlink_output = os.getenv("HARDLINK_OUTPUT", "") not in ("", "0")
+
+
+def _fast_copy(src: Path, dst: Path) -> None:
+    # Let the kernel move the bytes directly between the two files, instead of
+    # bouncing every chunk through userspace buffers. On copy-on-write
+    # filesystems (Btrfs/XFS), we can even reflink-clone the whole file in a
+    # single ioctl, which shares the data blocks and makes the "copy" O(1)
+    # regardless of the font's size. Falls back to a regular copy everywhere.
+    global _reflink_works, _hardlink_output
+
+    if _hardlink_output:
+        try:
+            dst.unlink(missing_ok=True)  # os.link refuses to overwrite.
+            os.link(os.path.realpath(src), dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # The source and output live on different filesystems, which can
+            # never hardlink, so copy normally for the rest of the build.
+            _hardlink_output = False
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    if _reflink_works:
+                        try:
+                            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+                            return
+                        except OSError:
+                            # The filesystem can't clone (e.g. ext4), so don't
+                            # bother asking again for the remaining files.
+                            _reflink_works = False
+
+                    remaining = os.fstat(src_fd).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                        if copied == 0:
+                            break  # EOF (the source shrank under us).
+                        remaining -= copied
+                    return
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+        except OSError as e:
+            # Some filesystem combos (or old kernels) refuse copy_file_range.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                raise
+
+    shutil.copyfile(src, dst, follow_symlinks=True)
+
+
 def copy_font(
-    font_file: Path, target_base_path: Path, *, target_name: str = None
-) -> Path:
+    font_file: Path,
+    target_base_path: Path,
+    *,
+    target_name: str = None,
+    family: str = None,
+    font_size: int = None,
+) -> tuple[Path, int]:
     # Use the same filename as the source, unless an override was provided.
     if target_name is None:
         target_name = font_file.name
 
-    # Figure out the generic family name to nicely sort the font.
-    font_family = get_font_family(font_file)
+    # The copy preserves the exact content size, so measuring the source spares
+    # callers from having to stat the fresh copy afterwards (and callers that
+    # already know the size can hand it in to skip even that stat).
+    if font_size is None:
+        font_size = font_file.stat().st_size
+
+    # Figure out the generic family name to nicely sort the font, unless the
+    # caller has already resolved it (which avoids a redundant lookup).
+    font_family = family if family is not None else get_font_family(font_file)
+
+    # NOTE: The family directory must already exist. copy_fonts pre-creates
+    # them all in bulk, which both avoids a stat+mkdir per font and keeps the
+    # parallel copy workers free of mkdir races.
     family_path = target_base_path / font_family
-    if not family_path.exists():
-        family_path.mkdir(mode=0o755, parents=True, exist_ok=True)
 
     # Perform a copy of the contents (not metadata), and throws if error.
     dest_font_file = family_path / target_name
-    shutil.copyfile(font_file, dest_font_file, follow_symlinks=True)
+    _fast_copy(font_file, dest_font_file)
     print(f'* "{dest_font_file}"')
 
-    return dest_font_file
+    return dest_font_file, font_size
+
+
+def _copy_font_if_changed(
+    font_file: Path, target_base_path: Path, target_name: str, family: str
+) -> int:
+    global _manifest_dirty
+    dest_font_file = target_base_path / family / target_name
+    manifest_key = str(dest_font_file.relative_to(OUTPUT_PATH))
+    src_stat = font_file.stat()
+
+    manifest_entry = _manifest.get(manifest_key)
+    if manifest_entry is not None and dest_font_file.is_file():
+        # Fast path: identical mtime and size means the source is unchanged,
+        # so the existing output file is still valid.
+        if (
+            manifest_entry["src_size"] == src_stat.st_size
+            and manifest_entry["src_mtime"] == src_stat.st_mtime
+        ):
+            return src_stat.st_size
+
+        # The mtime changed (e.g. the source folder was re-copied), so check
+        # the content hash before falling back to an actual copy.
+        if (
+            manifest_entry["src_size"] == src_stat.st_size
+            and manifest_entry["src_hash"] == _source_hash(font_file)
+        ):
+            manifest_entry["src_mtime"] = src_stat.st_mtime
+            _manifest_dirty = True
+            return src_stat.st_size
+
+    copy_font(
+        font_file,
+        target_base_path,
+        target_name=target_name,
+        family=family,
+        font_size=src_stat.st_size,
+    )
+    _manifest[manifest_key] = {
+        "src_mtime": src_stat.st_mtime,
+        "src_size": src_stat.st_size,
+        "src_hash": _source_hash(font_file),
+    }
+    _manifest_dirty = True
+    return src_stat.st_size
+
+
+def _prune_font_output(target_base_path: Path, expected_files: set[Path]) -> None:
+    global _manifest_dirty
+
+    # Delete any leftover output files that this build no longer produces
+    # (e.g. after the user changes their font groups), plus their manifest
+    # entries and any family directories that end up empty.
+    for dir_path, dir_names, file_names in os.walk(target_base_path, topdown=False):
+        for file_name in file_names:
+            stale_file = Path(dir_path) / file_name
+            if stale_file not in expected_files:
+                stale_file.unlink()
+                _manifest.pop(str(stale_file.relative_to(OUTPUT_PATH)), None)
+                _manifest_dirty = True
+        if Path(dir_path) != target_base_path and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+
+
+def copy_fonts(copy_tasks: list[tuple[Path, Path, str, str]]) -> int:
+    # Every task is a (font_file, target_base_path, target_name, family) tuple.
+    # Pre-create all family directories sequentially, so that the parallel
+    # copy workers never race each other on mkdir.
+    family_paths = {
+        target_base_path / family for (_, target_base_path, _, family) in copy_tasks
+    }
+    for family_path in family_paths:
+        family_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    # Copy the files concurrently. The copies are I/O-bound, and modern disks
+    # handle several streams well, but we still cap the workers to avoid
+    # thrashing purely disk-bound devices. Files whose sources are unchanged
+    # since the previous build are skipped entirely, thanks to the manifest.
+    final_size = 0
+    max_workers = min(8, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _copy_font_if_changed, font_file, target_base_path, target_name, family
+            )
+            for (font_file, target_base_path, target_name, family) in copy_tasks
+        ]
+        for future in as_completed(futures):
+            # Re-raises any copy error, to automatically abort the build.
+            final_size += future.result()
+
+    # Remove any obsolete outputs from previous builds.
+    expected_files = {
+        target_base_path / family / target_name
+        for (_, target_base_path, target_name, family) in copy_tasks
+    }
+    for target_base_path in {t[1] for t in copy_tasks}:
+        _prune_font_output(target_base_path, expected_files)
+
+    return final_size
 
 
 def run_ext(args: list[str], cwd: str | Path = None, encoding: str = "utf-8") -> str:
@@ -94,34 +375,142 @@ def run_ext(args: list[str], cwd: str | Path = None, encoding: str = "utf-8") ->
     return res.stdout
 
 
+def run_ext_parallel(commands: list[tuple[list[str], Path]]) -> None:
+    # Each entry is an (args, cwd) pair. The commands must be independent of
+    # each other, since they all run concurrently (one worker per CPU core).
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(run_ext, args, cwd=cwd) for args, cwd in commands]
+        for future in as_completed(futures):
+            # Re-raises any command error, to automatically abort the build.
+            future.result()
+
+
+def run_ext_pipeline(
+    producer_args: list[str], consumer_args: list[str], cwd: str | Path = None
+) -> None:
+    # Stream the producer's STDOUT straight into the consumer's STDIN, which
+    # avoids writing the intermediate data to disk just to read it back again.
+    producer = subprocess.Popen(producer_args, stdout=subprocess.PIPE)
+    consumer = subprocess.Popen(consumer_args, stdin=producer.stdout, cwd=cwd)
+
+    # Close our copy of the pipe, so the producer sees SIGPIPE if the consumer
+    # dies, instead of blocking forever on a full pipe buffer.
+    producer.stdout.close()
+
+    consumer_result = consumer.wait()
+    producer_result = producer.wait()
+    if producer_result != 0:
+        raise subprocess.CalledProcessError(producer_result, producer_args)
+    if consumer_result != 0:
+        raise subprocess.CalledProcessError(consumer_result, consumer_args)
+
+
+def _conditional_headers(target_file: Path) -> dict[str, str]:
+    # Ask the server to skip the transfer if our local copy is still fresh.
+    # This replicates wget's "--timestamping" behavior without needing wget.
+    if not target_file.is_file():
+        return {}
+    return {
+        "If-Modified-Since": email.utils.formatdate(
+            target_file.stat().st_mtime, usegmt=True
+        )
+    }
+
+
+def _store_download(response, target_file: Path) -> None:
+    # Stream to a temporary file and atomically swap it into place, so that
+    # an interrupted download can never clobber a good local copy.
+    # NOTE: Works with both urllib and http.client responses, since both offer
+    # chunked read() and a "headers" mapping.
+    temp_file = target_file.with_name(target_file.name + ".part")
+    with open(temp_file, "wb") as f:
+        while chunk := response.read(65536):
+            f.write(chunk)
+    os.replace(temp_file, target_file)
+
+    # Mirror the server's modification time locally, so that our future
+    # conditional requests compare against the true upstream timestamp.
+    last_modified = response.headers.get("Last-Modified")
+    if last_modified is not None:
+        server_time = email.utils.parsedate_to_datetime(last_modified).timestamp()
+        os.utime(target_file, (server_time, server_time))
+
+
 def download_if_newer(url: str, output_path: Path) -> None:
     if not output_path.exists():
         output_path.mkdir(mode=0o755, parents=True, exist_ok=True)
 
-    # Run wget, since it robustly handles downloads and timestamping. The user
-    # will still see progress, since wget uses STDERR for all status messages.
-    run_ext(
-        [
-            "wget",
-            # Disable the most verbose output (such as headers/redirect info).
-            "--quiet",
-            # Still display progress for the actual downloading.
-            "--show-progress",
-            # Only download files if new or updated since last time.
-            "--timestamping",
-            # We must change the output directory prefix. We cannot use wget's
-            # "output filename" option, because it deletes the target and thereby
-            # always creates a new file, thus conflicting with "--timestamping".
-            "--directory-prefix",
-            str(output_path.absolute()),
-            # The output filename will be based on whatever filename the server
-            # returns to us.
-            url,
-        ]
-    )
+    # The output filename is based on the URL's path, just like wget's default.
+    target_file = output_path / os.path.basename(urllib.parse.urlparse(url).path)
+
+    request = urllib.request.Request(url, headers=_conditional_headers(target_file))
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:  # Not Modified. Our local copy is up-to-date.
+            return
+        raise
+
+    with response:
+        _store_download(response, target_file)
+
+
+def download_many_if_newer(urls: list[str], output_path: Path) -> None:
+    # Downloads a batch of URLs that must all share one hostname, over a single
+    # persistent HTTP connection, so that only the first request pays the
+    # TCP+TLS handshake and all later files ride the Keep-Alive connection.
+    if not output_path.exists():
+        output_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    parsed_host = urllib.parse.urlsplit(urls[0])
+    if parsed_host.scheme == "https":
+        conn = http.client.HTTPSConnection(parsed_host.netloc)
+    else:
+        conn = http.client.HTTPConnection(parsed_host.netloc)
+
+    try:
+        for url in urls:
+            parsed = urllib.parse.urlsplit(url)
+            target_file = output_path / os.path.basename(parsed.path)
+            request_path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+
+            conn.request("GET", request_path, headers=_conditional_headers(target_file))
+            response = conn.getresponse()
+
+            if response.status == 304:  # Not Modified. Local copy is fresh.
+                response.read()  # Drain, so the connection can be reused.
+                continue
+
+            if response.status != 200:
+                # Redirects (or anything else unexpected) fall back to urllib,
+                # which follows them automatically on a fresh connection.
+                response.read()
+                download_if_newer(url, output_path)
+                continue
+
+            _store_download(response, target_file)
+    finally:
+        conn.close()
+
+
+def _english_names(names_text: str) -> list[str]:
+    # Every line is "<family> (<lang>)", so a plain suffix check picks out the
+    # English names without needing a regex pass over the fc-scan output.
+    return [
+        line[: -len(" (en)")]
+        for line in names_text.splitlines()
+        if line.endswith(" (en)")
+    ]
 
 
 def get_font_family(font_file: Path) -> str:
+    # Check the persistent cache first, so unchanged fonts skip the subprocess
+    # and the full font parse that fc-scan would perform.
+    cache_key = _family_cache_key(font_file)
+    cached_family = _family_cache.get(cache_key)
+    if cached_family is not None:
+        return cached_family
+
     # Get all English names for the font, or fail if no English found.
     # NOTE: All fonts seem to have English names, as a standardized rule.
     raw_result = run_ext(
@@ -135,15 +524,81 @@ def get_font_family(font_file: Path) -> str:
             str(font_file.absolute()),
         ]
     )
-    english_names = re.findall(r"(?m)^(.+?) \(en\)$", raw_result)
+    english_names = _english_names(raw_result)
     if not english_names:
         raise LookupError(f'No english names in font "{font_file.name}".')
 
     # Return the first English family name, since fonts always seem to list the
     # primary family name first, and more specific names later.
+    global _family_cache_dirty
+    _family_cache[cache_key] = english_names[0]
+    _family_cache_dirty = True
     return english_names[0]
 
 
+def get_font_families(
+    font_files: list[Path], *, stats: dict[Path, os.stat_result] = None
+) -> dict[Path, str]:
+    # Callers that walked a directory anyway can pass the stat results along,
+    # so the cache keys below don't have to re-stat every file.
+    if stats is None:
+        stats = {}
+
+    # Resolve as many fonts as possible from the persistent cache first.
+    families: dict[Path, str] = {}
+    to_scan: list[Path] = []
+    for font_file in font_files:
+        cache_key = _family_cache_key(font_file, stats.get(font_file))
+        cached_family = _family_cache.get(cache_key)
+        if cached_family is not None:
+            families[font_file] = cached_family
+        else:
+            to_scan.append(font_file)
+
+    if not to_scan:
+        return families
+
+    # fc-scan accepts many files per invocation, so a single subprocess can
+    # resolve every uncached font, instead of paying one exec per file. We wrap
+    # each font's pattern in FILE/END sentinels to split the combined output.
+    # NOTE: Font collections (".ttc") print one pattern per contained font, but
+    # every pattern carries its own FILE sentinel, so the split stays correct
+    # (and the first pattern per file wins, matching get_font_family).
+    raw_result = run_ext(
+        [
+            "fc-scan",
+            "--format",
+            "FILE:%{file}\n"
+            r"%{[]family,familylang{%{family} (%{familylang})\n}}"
+            "END\n",
+            *[str(f.absolute()) for f in to_scan],
+        ]
+    )
+
+    path_lookup = {str(f.absolute()): f for f in to_scan}
+    global _family_cache_dirty
+    for block in raw_result.split("END\n"):
+        block = block.strip()
+        if not block:
+            continue
+        file_line, _, names_text = block.partition("\n")
+        font_file = path_lookup[file_line.removeprefix("FILE:")]
+        if font_file in families:
+            continue  # Keep the first pattern for ".ttc" collections.
+
+        english_names = _english_names(names_text)
+        if not english_names:
+            raise LookupError(f'No english names in font "{font_file.name}".')
+
+        families[font_file] = english_names[0]
+        _family_cache[_family_cache_key(font_file, stats.get(font_file))] = (
+            english_names[0]
+        )
+        _family_cache_dirty = True
+
+    return families
+
+
 def get_web_text(url: str, encoding: str = "utf-8") -> str:
     # Throws if there are any issues with the fetching or decoding.
     with urllib.request.urlopen(url) as f:
@@ -166,19 +621,24 @@ def process_microsoft(windows_version: int = 11) -> int:
     # fonts from a non-fresh Windows installation will still have the "old names".
     # The only thing we can trust is that the actual filenames for all fonts will
     # exist (news/updates), but we can't trust the filename casing of any of them.
+    # NOTE: We use os.scandir instead of glob, since its DirEntry objects carry
+    # the stat data from the directory walk itself, so grabbing every file's
+    # size here avoids one extra stat syscall per font in the sizing loop below.
     local_file_map = {}
-    for local_file in source_fonts.glob("*"):
-        if local_file.is_file():
-            lower_name = local_file.name.lower()
+    local_size_map = {}
+    for dir_entry in os.scandir(source_fonts):
+        if dir_entry.is_file():
+            lower_name = dir_entry.name.lower()
             # Sanity check. It should be impossible to have clashing names with
             # different case, since Windows is case-insensitive, but this protects
             # against messy font collections that have passed through other disks.
             if lower_name in local_file_map:
                 print(
-                    f'Clashing files discovered for "{lower_name}": "{local_file}" and "{local_file_map[lower_name]}" have the same name. Please fix your source Fonts directory, and ensure that it comes from a fully updated Windows {windows_version} installation.'
+                    f'Clashing files discovered for "{lower_name}": "{dir_entry.path}" and "{local_file_map[lower_name]}" have the same name. Please fix your source Fonts directory, and ensure that it comes from a fully updated Windows {windows_version} installation.'
                 )
                 exit(1)
-            local_file_map[lower_name] = local_file
+            local_file_map[lower_name] = Path(dir_entry.path)
+            local_size_map[lower_name] = dir_entry.stat().st_size
 
     # Fetch font groups from Arch's AUR package (for easy filtering of unwanted fonts).
     # NOTE: The given "windows_version" must point at a valid PKGSPEC. Historically,
@@ -187,12 +647,24 @@ def process_microsoft(windows_version: int = 11) -> int:
     upstream_pkg_base = "https://aur.archlinux.org/cgit/aur.git/plain/PKGBUILD"
     upstream_pkg_url = f"{upstream_pkg_base}?h=ttf-ms-win{windows_version}-auto"
     raw_pkgspec = get_web_text(upstream_pkg_url)
-    for m_grp in re.finditer(r"(?s)_ttf_ms_([^=]+)=\((.+?)\n\)", raw_pkgspec):
-        group_name = m_grp.group(1)
 
-        font_groups[group_name] = []
-        for m_font in re.finditer(r"(\S+)", re.sub(r"(?m)#.*$", "", m_grp.group(2))):
-            font_groups[group_name].append(m_font.group(1))
+    # Parse the PKGBUILD linewise in a single pass, instead of stacking three
+    # regex passes (group extraction, comment stripping, tokenizing) on top of
+    # each other. Every group is a shell array which looks like this:
+    #   _ttf_ms_win11=(
+    #     SomeFont.ttf # Optional comment.
+    #   )
+    current_group = None
+    for line in raw_pkgspec.splitlines():
+        if current_group is None:
+            if line.startswith("_ttf_ms_") and "=(" in line:
+                current_group = line[len("_ttf_ms_") :].partition("=")[0]
+                font_groups[current_group] = []
+        elif line.startswith(")"):
+            current_group = None
+        else:
+            # Strip any trailing comment and tokenize the remaining filenames.
+            font_groups[current_group].extend(line.partition("#")[0].split())
 
     # Figure out which filters we want to use. By default, we skip all Asian fonts,
     # since their files are utterly humongous.
@@ -227,7 +699,7 @@ def process_microsoft(windows_version: int = 11) -> int:
                 exit(1)
 
             actual_font_file = local_file_map[lower_font_file]
-            group_size += actual_font_file.stat().st_size
+            group_size += local_size_map[lower_font_file]
 
             # Store a mapping of the on-disk name and expected (target) name.
             if install_this_group:
@@ -260,15 +732,21 @@ def process_microsoft(windows_version: int = 11) -> int:
 
     # Scan all enabled font groups and copy them into the correct output directories, sorted by family name.
     print("Copying selected Microsoft fonts...")
-    final_size = 0
+    family_map = get_font_families([x["source_path"] for x in to_install.values()])
+    copy_tasks = []
     for k in sorted(to_install.keys()):
         font_info = to_install[k]
 
         # Copy using the case-sensitive, expected filename instead of the source's name.
-        target_file = copy_font(
-            font_info["source_path"], target_path, target_name=font_info["target_name"]
+        copy_tasks.append(
+            (
+                font_info["source_path"],
+                target_path,
+                font_info["target_name"],
+                family_map[font_info["source_path"]],
+            )
         )
-        final_size += target_file.stat().st_size
+    final_size = copy_fonts(copy_tasks)
 
     print(f"\nOutput font size (Microsoft): {bytes_to_mib(final_size)}.\n")
 
@@ -292,7 +770,7 @@ def process_apple() -> int:
 
     # Fetch the URLs for all DMG packages.
     raw_html = get_web_text("https://developer.apple.com/fonts/")
-    dmg_urls = re.findall(r'(?m)http[^"]+?\.dmg', raw_html)
+    dmg_urls = _DMG_URL_RE.findall(raw_html)
     if not dmg_urls:
         print("Couldn't find any DMG files on Apple's fonts website.")
         exit(1)
@@ -301,10 +779,30 @@ def process_apple() -> int:
     # NOTE: This is incredibly fast if local DMGs already exist, since it only
     # downloads the files again if they've changed since last time.
     print("Downloading new or updated Apple font DMG files...")
-    process_dmgs = []
     dmg_source_path = SOURCE_PATH / "apple-dmgs"
+
+    # Group the URLs by hostname, so that each host's files share one
+    # persistent Keep-Alive connection, and fetch the hosts concurrently,
+    # since each one is network-bound and pays its own handshake latency.
+    host_urls: dict[str, list[str]] = {}
+    for dmg_url in dmg_urls:
+        hostname = urllib.parse.urlsplit(dmg_url).hostname
+        host_urls.setdefault(hostname, []).append(dmg_url)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        future_hosts = {
+            executor.submit(download_many_if_newer, urls, dmg_source_path): urls
+            for urls in host_urls.values()
+        }
+        for future in as_completed(future_hosts):
+            # Re-raises any download error, to automatically abort the build.
+            future.result()
+            for dmg_url in future_hosts[future]:
+                print(f"* {os.path.basename(dmg_url)}")
+
+    # Build the list of local files afterwards, to keep the order deterministic.
+    process_dmgs = []
     for dmg_url in dmg_urls:
-        download_if_newer(dmg_url, dmg_source_path)
         # NOTE: Thanks to our regex we know that every URL ends in ".dmg".
         process_dmgs.append(dmg_source_path / os.path.basename(dmg_url))
     print("")
@@ -315,72 +813,112 @@ def process_apple() -> int:
             print(f'Missing "{dmg_file}". Please try again.')
             exit(1)
 
-    # Ensure that the temporary extraction path exists and is empty.
-    dmg_extract_path = TEMP_PATH / "apple-extract"
-    rmtree(dmg_extract_path)
-    dmg_extract_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+    # Key the extraction directory by the exact DMG set (names, sizes and
+    # mtimes), so that re-runs with unchanged DMGs can skip the expensive 7zip
+    # stages entirely, while any changed DMG automatically gets a fresh
+    # directory. A marker file distinguishes finished extractions from aborted
+    # ones, since a partial directory must never be trusted.
+    hasher = hashlib.sha256()
+    for dmg_file in sorted(process_dmgs):
+        dmg_stat = dmg_file.stat()
+        hasher.update(
+            f"{dmg_file.name}|{dmg_stat.st_size}|{int(dmg_stat.st_mtime)}\n".encode()
+        )
+    dmg_extract_path = TEMP_PATH / f"apple-extract-{hasher.hexdigest()[:16]}"
+    extract_done_marker = dmg_extract_path / ".complete"
+    fonts_extract_path = dmg_extract_path / "fonts"
+
+    # Garbage-collect extraction directories from old DMG sets, once they
+    # haven't been touched for a week.
+    if TEMP_PATH.is_dir():
+        for dir_entry in os.scandir(TEMP_PATH):
+            if (
+                dir_entry.name.startswith("apple-extract-")
+                and Path(dir_entry.path) != dmg_extract_path
+                and dir_entry.stat().st_mtime < time.time() - 7 * 86400
+            ):
+                rmtree(Path(dir_entry.path))
 
     # Extract the layered Apple DMG files.
     # NOTE: If 7zip errors anytime, we'll automatically throw an error and abort.
-    print("Extracting Apple font packages...")
-
-    # First extract the font's ".pkg" file from the ".dmg" container.
-    for dmg_file in process_dmgs:
-        run_ext(
+    if extract_done_marker.is_file():
+        print("Extracting Apple font packages... (reusing cached extraction)")
+    else:
+        # Drop any partial leftovers from an aborted extraction.
+        rmtree(dmg_extract_path)
+        dmg_extract_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+        print("Extracting Apple font packages...")
+
+        # The files within each stage are independent, and 7zip extraction is
+        # CPU-bound, so every stage runs its extractions in parallel (but we
+        # still need the stages themselves to run in order, since they feed
+        # each other).
+
+        # First extract the font's ".pkg" file from the ".dmg" container.
+        run_ext_parallel(
             [
-                "7z",
-                "e",  # Extract.
-                # Only extract the Fonts.pkg file (via wildcard), nothing else.
-                r"-ir!*Fonts.pkg",
-                # Overwrite any files that already exist.
-                "-aoa",
-                str(dmg_file.absolute()),
-            ],
-            cwd=dmg_extract_path.absolute(),
+                (
+                    [
+                        "7z",
+                        "e",  # Extract.
+                        # Only extract the Fonts.pkg file (via wildcard), nothing else.
+                        r"-ir!*Fonts.pkg",
+                        # Overwrite any files that already exist.
+                        "-aoa",
+                        str(dmg_file.absolute()),
+                    ],
+                    dmg_extract_path.absolute(),
+                )
+                for dmg_file in process_dmgs
+            ]
         )
 
-    # Now extract the payloads from every ".pkg" file.
-    for pkg_file in dmg_extract_path.glob("*Fonts.pkg"):
-        # We will put every payload into unique sub-directories, since every
-        # file is named "Payload~". 7zip has a "-so" option which could be used
-        # to force the output to stdout instead, but then we'd have to redirect,
-        # which is way more annoying than simply using separate folders.
-        payload_extract_path = dmg_extract_path / f"{pkg_file.name}.payload"
-        payload_extract_path.mkdir(mode=0o755, parents=True, exist_ok=True)
-
-        run_ext(
-            [
-                "7z",
-                "e",  # Extract.
-                # Overwrite any files that already exist.
-                "-aoa",
-                str(pkg_file.absolute()),
-                # Tell it the EXACT name of the file we want to extract.
-                "Payload~",
-            ],
-            cwd=payload_extract_path.absolute(),
-        )
+        # Now stream every ".pkg" payload straight into a second 7zip instance
+        # that extracts the font files. Every payload is named "Payload~" and
+        # weighs hundreds of MB, so piping it skips writing (and re-reading)
+        # those huge intermediate archives, and removes the per-pkg payload
+        # sub-directories.
+        # NOTE: Apple only uses ".otf" and ".ttf", but we add ".ttc" just in case.
+        fonts_extract_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [
+                executor.submit(
+                    run_ext_pipeline,
+                    [
+                        "7z",
+                        "e",  # Extract.
+                        # Write the extracted file to STDOUT instead of to disk.
+                        "-so",
+                        str(pkg_file.absolute()),
+                        # Tell it the EXACT name of the file we want to extract.
+                        "Payload~",
+                    ],
+                    [
+                        "7z",
+                        "e",  # Extract.
+                        # Read the archive from STDIN.
+                        "-si",
+                        # The payload stream is a cpio archive, and 7zip can't probe
+                        # archive types on STDIN like it does on files.
+                        "-tcpio",
+                        # Only extract the font files, nothing else.
+                        # NOTE: This squashes the payload's internal "Library/Fonts" paths.
+                        r"-ir!*.otf",
+                        r"-ir!*.ttf",
+                        r"-ir!*.ttc",
+                        # Overwrite any files that already exist.
+                        "-aoa",
+                    ],
+                    cwd=fonts_extract_path.absolute(),
+                )
+                for pkg_file in dmg_extract_path.glob("*Fonts.pkg")
+            ]
+            for future in as_completed(futures):
+                # Re-raises any extraction error, to automatically abort the build.
+                future.result()
 
-    # Extract the actual font files from all of the payloads.
-    # NOTE: Apple only uses ".otf" and ".ttf", but we add ".ttc" just in case.
-    fonts_extract_path = dmg_extract_path / "fonts"
-    fonts_extract_path.mkdir(mode=0o755, parents=True, exist_ok=True)
-    for payload_file in dmg_extract_path.glob("*.payload/Payload~"):
-        a = run_ext(
-            [
-                "7z",
-                "e",  # Extract.
-                # Only extract the font files, nothing else.
-                # NOTE: This squashes the payload's internal "Library/Fonts" paths.
-                r"-ir!*.otf",
-                r"-ir!*.ttf",
-                r"-ir!*.ttc",
-                # Overwrite any files that already exist.
-                "-aoa",
-                str(payload_file.absolute()),
-            ],
-            cwd=fonts_extract_path.absolute(),
-        )
+        extract_done_marker.touch()
     print("")
 
     # Apple ships legacy versions of some fonts, which are named things like
@@ -392,26 +930,29 @@ def process_apple() -> int:
     # NOTE: The legacy fonts also waste a lot of disk space, since they need
     # to contain duplicate glyphs, whereas the modern, unified fonts are small.
     to_keep = []
+    keep_stats = {}
     to_delete = []
-    for f in fonts_extract_path.glob("*"):
+    for dir_entry in os.scandir(fonts_extract_path):
         # Since Python's "glob" is very basic, we'll use a regex which is
         # equivalent to the following shell patterns:
         # ./SF-Pro-{Text,Display}*.otf
         # ./SF-Compact-{Text,Display}*.otf
         # ./NewYork{Small,Medium,Large,ExtraLarge}*.otf
-        # NOTE: Glob files are in a jumbled order, so we'll use sorted lists
-        # to display the delete/keep filenames in a nice order later.
-        m = re.match(
-            r"^(?:SF-(?:Pro|Compact)-(?:Text|Display)|NewYork(?:Small|Medium|Large|ExtraLarge)).*?\.otf$",
-            f.name,
-        )
+        # NOTE: Directory entries are in a jumbled order, so we'll use sorted
+        # lists to display the delete/keep filenames in a nice order later.
+        # NOTE: We grab each doomed file's size straight from the DirEntry,
+        # which spares us from re-statting it in the deletion loop below.
+        m = _LEGACY_APPLE_RE.match(dir_entry.name)
         if m:
-            to_delete.append(f)
+            to_delete.append((Path(dir_entry.path), dir_entry.stat().st_size))
         else:
             # Keep if it's a font file (case sensitive match).
-            m = re.search(r"\.(?:otf|ttf|ttc)$", f.name)
+            m = _FONT_EXT_RE.search(dir_entry.name)
             if m:
-                to_keep.append(f)
+                font_file = Path(dir_entry.path)
+                to_keep.append(font_file)
+                # Remember the stat data too, for the family analysis later.
+                keep_stats[font_file] = dir_entry.stat()
 
     to_keep = sorted(to_keep)
     to_delete = sorted(to_delete)
@@ -419,9 +960,9 @@ def process_apple() -> int:
     # Delete the useless legacy fonts.
     print("Deleting legacy Apple fonts...")
     deleted_size = 0
-    for font_file in to_delete:
+    for font_file, font_size in to_delete:
         print(f"* {font_file.name}")
-        deleted_size += font_file.stat().st_size
+        deleted_size += font_size
         font_file.unlink(missing_ok=False)  # Throws if already missing.
     print(f"Deleted {bytes_to_mib(deleted_size)} of useless legacy fonts.\n")
 
@@ -445,8 +986,9 @@ def process_apple() -> int:
     # legacy font packages above).
     print("Analyzing Apple font packages...")
     font_families = {}
+    family_map = get_font_families(to_keep, stats=keep_stats)
     for font_file in to_keep:
-        font_family = get_font_family(font_file)
+        font_family = family_map[font_file]
         if font_family not in font_families:
             font_families[font_family] = []
         font_families[font_family].append(font_file)
@@ -461,16 +1003,17 @@ def process_apple() -> int:
 
     # Copy all fonts to the correct output directories, sorted by family name.
     print("Copying all Apple fonts...")
-    final_size = 0
+    copy_tasks = []
     for font_family in sorted(font_families.keys()):
         for font_file in font_families[font_family]:
-            target_file = copy_font(font_file, target_path)
-            final_size += target_file.stat().st_size
+            copy_tasks.append((font_file, target_path, font_file.name, font_family))
+    final_size = copy_fonts(copy_tasks)
 
     print(f"\nOutput font size (Apple): {bytes_to_mib(final_size)}.\n")
 
-    # Clean up temporary files.
-    rmtree(dmg_extract_path)
+    # NOTE: We intentionally keep the extraction directory around, so that the
+    # next build with the same DMG set can skip the 7zip stages entirely (the
+    # garbage collection above reaps it once the DMG set changes).
 
     return final_size
 
@@ -483,13 +1026,14 @@ print(
 print("***\n")
 
 # Check external dependencies.
-deps = ["wget", "7z", "fc-scan"]
-for dep in deps:
-    if not command_exists(dep):
+deps = ["7z", "fc-scan"]
+missing_deps = find_missing_deps(deps)
+if missing_deps:
+    for dep in missing_deps:
         print(
             f'Missing external dependency "{dep}". Please install it and ensure that it exists in your PATH environment.'
         )
-        exit(1)
+    exit(1)
 
 # Determine which Windows version we're using as source.
 # NOTE: The user can provide the environment variable to change the version,
@@ -499,11 +1043,11 @@ windows_version = int(os.getenv("WINDOWS_VERSION", "11"), 10)
 # Build the font collections.
 time_start = time.time()
 
-rmtree(OUTPUT_PATH)  # Remove any leftover files.
+# NOTE: We no longer wipe OUTPUT_PATH here. The manifest-driven copy skips
+# unchanged files and prunes obsolete ones, so warm rebuilds stay incremental.
 output_size = 0
 output_size += process_microsoft(windows_version)
 output_size += process_apple()
-rmtree(TEMP_PATH)
 print(f"Output font size (Total): {bytes_to_mib(output_size)}.\n")
 
 time_elapsed = round(time.time() - time_start)